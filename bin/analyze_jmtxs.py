@@ -8,17 +8,17 @@ JMTX data (together with their "taint" data) to a file.
 
 import pickle
 import numpy as np
-from collections import OrderedDict
+from collections import defaultdict, deque
 from argparse import ArgumentParser
 
-from jm_unmixer.misc import gzopen, iter_pkl_list, progressbar, map_with_progressbar
-from jm_unmixer.jmtx import UnmixedJoinMarketTx, get_vout_addresses
+from jm_unmixer.misc import zstdopen, iter_pkl_list, progressbar, map_with_progressbar, PICKLE_PROTOCOL
+from jm_unmixer.jmtx import UnmixedJoinMarketTx, get_vout_addresses, get_maker_vout_idxs, get_spending_index, compute_unmix_levels
 
 ###############################################################################
 # functions
 
 def extract_maker_addresses(jmtxs, num_workers = 1):
-    tx_addresses_list = map_with_progressbar(extract_maker_addresses_from_tx, jmtxs.values(), num_workers = num_workers)
+    tx_addresses_list = map_with_progressbar(extract_maker_addresses_from_tx, jmtxs.values(), num_workers = num_workers, total = len(jmtxs))
     addresses = set()
     for tx_addresses in tx_addresses_list:
         addresses.update(tx_addresses)
@@ -26,11 +26,13 @@ def extract_maker_addresses(jmtxs, num_workers = 1):
 
 def extract_maker_addresses_from_tx(jmtx):
     addresses = set()
-    vin_values = list(jmtx.vin_values)
+    # value -> indices of the vins with that value (in order)
+    vin_idxs_by_value = defaultdict(deque)
+    for i, value in enumerate(jmtx.vin_values):
+        vin_idxs_by_value[value].append(i)
     for maker_pair in jmtx.maker_value_pairs:
         for value in maker_pair[0]:
-            i = vin_values.index(value)
-            vin_values[i] = None
+            i = vin_idxs_by_value[value].popleft()
             vin = jmtx.vin[i]
             back_vout = jmtx.get_vout_being_spent_by_vin(vin)
             for addr in get_vout_addresses(back_vout):
@@ -39,43 +41,57 @@ def extract_maker_addresses_from_tx(jmtx):
     return addresses
 
 def mark_makers(jmtxs, maker_address_set):
-    with progressbar(jmtxs.items()) as ITEMS:
-        tjmtxs = OrderedDict()
+    # done serially: this pass is cheaper than pickling the jmtxs to worker processes
+    tjmtxs = {}
+    with progressbar(jmtxs.items(), length = len(jmtxs)) as ITEMS:
         for txid, tx in ITEMS:
-            ttx = UnmixedJoinMarketTx(tx)
-            for vout in tx.vout:
-                vout_addrs = get_vout_addresses(vout)
-                vout_maker_addrs = maker_address_set & set(vout_addrs)
-                # if there are maker addresses in this vout, then all addresses in this vout are maker addresses
-                if vout_maker_addrs:
-                    for addr in vout_addrs:
-                        ttx.add_maker_address(addr)
-            tjmtxs[txid] = ttx
-        return tjmtxs
-
-def get_unmix_levels(tjmtxs, num_workers = 1):
-    return list(map_with_progressbar(get_unmix_level, tjmtxs, num_workers = num_workers))
-
-def get_unmix_level(tx):
-    return tx.unmix_level
+            tjmtxs[txid] = UnmixedJoinMarketTx(tx, get_maker_vout_addresses(tx, maker_address_set))
+    return tjmtxs
+
+def get_maker_vout_addresses(tx, maker_address_set):
+    # if there are maker addresses in a vout, then all addresses in this vout are maker addresses
+    vouts = tx.vout
+    return [
+        addr
+        for i in get_maker_vout_idxs(vouts, maker_address_set)
+        for addr in get_vout_addresses(vouts[i])
+    ]
+
+def get_num_parties(tjmtxs):
+    return np.fromiter((tx.num_parties for tx in tjmtxs), dtype = np.int32, count = len(tjmtxs))
+
+def get_unmix_levels(tjmtxs, num_parties, num_workers = 1):
+    # only the per-tx counts are computed per tx; unmix levels are computed over the arrays
+    num_possible_takers = np.fromiter(
+        map_with_progressbar(get_num_possible_takers, tjmtxs, num_workers = num_workers, total = len(tjmtxs)),
+        dtype = np.int32, count = len(tjmtxs))
+    return compute_unmix_levels(num_parties, num_possible_takers)
+
+def get_num_possible_takers(tx):
+    return len(tx.possible_taker_mixed_vouts)
 
 def get_all_jmtxs(infiles):
-    txs = OrderedDict()
+    txs = {}
     for infile in infiles:
         for tx in iter_pkl_list(infile):
             txs[tx.id] = tx
     return txs
 
 def print_summary(tjmtxs, unmix_levels_raw):
-    unmix_levels = np.array([ uml for uml in unmix_levels_raw if uml is not None ])
+    unmix_levels = unmix_levels_raw[~np.isnan(unmix_levels_raw)]
+    n = len(unmix_levels)
+    # a single partition yields min, median and max (instead of a full sort and two more passes)
+    mid = n // 2
+    parted = np.partition(unmix_levels, [ 0, max(mid - 1, 0), mid, n - 1 ])
+    median = parted[mid] if n % 2 else (parted[mid - 1] + parted[mid]) / 2
 
     print('NUM JMTXS: %s' % len(tjmtxs))
-    print('NUM JMTXS WITH UNMIX LEVEL: %s' % (len(unmix_levels)))
-    print('AVG UNMIX LEVEL:     %.2f' % (np.mean(unmix_levels)))
-    print('MEDIAN UNMIX LEVEL:  %.2f' % (np.median(unmix_levels)))
-    print('MIN UNMIX LEVEL:     %.2f' % (np.min(unmix_levels)))
-    print('MAX UNMIX LEVEL:     %.2f' % (np.max(unmix_levels)))
-    print('FULLY UNMIXED FRAC:  %.2f' % (np.sum(unmix_levels == 1) / float(len(unmix_levels))))
+    print('NUM JMTXS WITH UNMIX LEVEL: %s' % (n))
+    print('AVG UNMIX LEVEL:     %.2f' % (unmix_levels.mean()))
+    print('MEDIAN UNMIX LEVEL:  %.2f' % (median))
+    print('MIN UNMIX LEVEL:     %.2f' % (parted[0]))
+    print('MAX UNMIX LEVEL:     %.2f' % (parted[-1]))
+    print('FULLY UNMIXED FRAC:  %.2f' % (np.count_nonzero(unmix_levels == 1) / float(n)))
 
 ###############################################################################
 # MAIN
@@ -89,7 +105,8 @@ def main():
     jmtxs = get_all_jmtxs(args.infiles)
     print('%d jmtxs found' % ( len(jmtxs), ))
     if args.num_txs:
-        jmtxs = OrderedDict(list(jmtxs.items())[-args.num_txs:])
+        # keep only the last num_txs items, without materializing the list of all items
+        jmtxs = dict(deque(jmtxs.items(), maxlen = args.num_txs))
         print('%d jmtxs to process (quick mode)' % ( len(jmtxs), ))
     
     # pass1: remember all makers
@@ -102,13 +119,22 @@ def main():
     tjmtxs = mark_makers(jmtxs, maker_address_set)
 
     print('PASS 3: CALCULATING UNMIX LEVELS')
-    unmix_levels = get_unmix_levels(tjmtxs.values(), num_workers = args.num_workers)
+    num_parties = get_num_parties(tjmtxs.values())
+    unmix_levels = get_unmix_levels(tjmtxs.values(), num_parties, num_workers = args.num_workers)
 
     # dump to a file
     if args.outfile:
         print('writing outfile to: %s' % args.outfile)
-        with gzopen(args.outfile, 'wb') as F:
-            pickle.dump(( tjmtxs, unmix_levels, maker_address_set ), F)
+        # precomputed here, so print_unmixed_jmtx.py doesn't need to rebuild it on every run
+        spending_index = get_spending_index(tjmtxs.values())
+        # per-tx data is stored in arrays, and each tx is pickled into a separate blob, so
+        # print_unmixed_jmtx.py only needs to unpickle the few txs it displays
+        txids = np.array(list(tjmtxs.keys()))
+        tx_blobs = [ pickle.dumps(tx, protocol = PICKLE_PROTOCOL) for tx in tjmtxs.values() ]
+        with zstdopen(args.outfile, 'wb') as F:
+            # each object is pickled separately, so readers can skip loading the ones they don't need
+            for obj in ( txids, maker_address_set, spending_index, tx_blobs, unmix_levels, num_parties ):
+                pickle.dump(obj, F, protocol = PICKLE_PROTOCOL)
     
     # stats and output:
     print('STATS')
@@ -5,10 +5,11 @@ This script prints JMTXs IDs, and optionally dumps them to a pickle file.
 """
 
 import os
+from functools import lru_cache
 from argparse import ArgumentParser
 
-from jm_unmixer.misc import pkl_append, map_with_progressbar
-from jm_unmixer.btccommon import BLOCKCHAIN, Block, Tx, reconnect
+from jm_unmixer.misc import pkl_append, map_with_progressbar, progressbar
+from jm_unmixer.btccommon import BLOCKCHAIN, Block, Tx, disconnect
 from jm_unmixer.jmtx import to_joinmarket_tx, Unpairable
 
 ###############################################################################
@@ -19,8 +20,10 @@ ARG_TYPE_BLOCK_HEIGHT = 1
 ARG_TYPE_TX_ID = 2
 ARG_TYPE_FILE = 3
 
-def gen_txids_from_args(args, num_workers):
-    arg_types = set([ get_arg_type(arg) for arg in args ])
+HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+
+def gen_txids_from_args(args):
+    arg_types = set(map(get_arg_type, args))
     if len(arg_types) > 1:
         raise ValueError('bad usage: ambiguous arg types (%s)' % arg_types)
     arg_type, = arg_types
@@ -40,8 +43,7 @@ def gen_txids_from_args(args, num_workers):
         else:
             raise ValueError('Block heights should pe passed as a start/end range')
         txids = []
-        block_txids_gen = map_with_progressbar(get_block_txids, hs, num_workers = num_workers, preserve_order = False)
-        for block_txids in block_txids_gen:
+        for block_txids in gen_blocks_txids(hs):
             txids.extend(block_txids)
         yield from txids
     elif arg_type == ARG_TYPE_TX_ID:
@@ -54,16 +56,18 @@ def gen_txids_from_args(args, num_workers):
                     if txid:
                         yield txid
 
-def get_block_txids(height):
-    block = Block(BLOCKCHAIN.get_block_by_height(height))
-    return block.txids
+def gen_blocks_txids(heights):
+    # blocks are fetched in batches, a single RPC round-trip per batch
+    blocks = BLOCKCHAIN.iter_blocks_by_heights(heights)
+    with progressbar(blocks, length = len(heights)) as BLOCKS:
+        for block_json in BLOCKS:
+            yield Block(block_json).txids
 
+@lru_cache(maxsize = None)
 def get_arg_type(arg):
     
-    if os.path.exists(arg):
-        return ARG_TYPE_FILE
-    
-    if len(arg) == 64:
+    # the cheap checks come first, so txids and heights don't cost a stat() each
+    if len(arg) == 64 and HEX_DIGITS.issuperset(arg):
         if arg.startswith('0000000'):
             return ARG_TYPE_BLOCK_ID
         else:
@@ -71,22 +75,17 @@ def get_arg_type(arg):
     try:
         if int(arg) < 10**9:
             return ARG_TYPE_BLOCK_HEIGHT
-    except TypeError:
+    except ValueError:
         pass
     
+    if os.path.exists(arg):
+        return ARG_TYPE_FILE
+    
     raise ValueError('Arg not understood: %s' % arg)
 
 ###############################################################################
 
-pid_of_connection = os.getpid()
-
 def process_tx(txid):
-    
-    global pid_of_connection
-    if os.getpid() != pid_of_connection:
-        reconnect()
-        pid_of_connection = os.getpid()
-    
     tx = Tx.from_id(txid)
     try:
         return to_joinmarket_tx(tx)
@@ -101,10 +100,13 @@ def main():
     args = getopt()
     
     print('collecting txids...')
-    txids = list(gen_txids_from_args(args.args, num_workers = args.num_workers))
+    txids = list(gen_txids_from_args(args.args))
     print('%d txs found' % (len(txids)))
     print('looking for jmtxs...')
-    jmtx_gen = map_with_progressbar(process_tx, txids, num_workers = args.num_workers, preserve_order = False)
+    # each worker drops the connection inherited from the parent, and lazily opens its own,
+    # once.  (the initializer must not fail: Pool would respawn failing workers forever.)
+    jmtx_gen = map_with_progressbar(process_tx, txids, num_workers = args.num_workers, preserve_order = False, total = len(txids),
+                                    initializer = disconnect)
     jmtxs = list(jmtx_gen)
     for jmtx in jmtxs:
         if jmtx is None:
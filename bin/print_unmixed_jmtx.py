@@ -5,19 +5,49 @@ makers, which belong to the taker, and the links to other JMTXs which were explo
 in order to unmix this JMTX.
 """
 
-from collections import OrderedDict
 import pickle
 import numpy as np
 from argparse import ArgumentParser
 
-from jm_unmixer.misc import gzopen
+from jm_unmixer.misc import zstdopen
+from jm_unmixer.btccommon import satoshis_to_btc
 from jm_unmixer.jmtx import get_vout_addresses
 
 
+###############################################################################
+# TxStore
+
+class TxStore(object):
+    """
+    A read-only txid->tx mapping of the txs in the unmixing-data file.
+    Txs are stored pickled, and are only unpickled when accessed.
+    """
+    
+    def __init__(self, txids, tx_blobs):
+        self.txids = txids
+        self.tx_blobs = tx_blobs
+        self._order = np.argsort(txids)
+        self._sorted_txids = txids[self._order]
+    
+    def __len__(self):
+        return len(self.txids)
+    
+    def __getitem__(self, txid):
+        return self.get_by_index(self.index(txid))
+    
+    def index(self, txid):
+        i = np.searchsorted(self._sorted_txids, txid)
+        if i == len(self._sorted_txids) or self._sorted_txids[i] != txid:
+            raise KeyError(txid)
+        return self._order[i]
+
+    def get_by_index(self, idx):
+        return pickle.loads(self.tx_blobs[idx])
+
 ###############################################################################
 # functions
 
-def describe_tx(tjmtx, tjmtxs, maker_address_set):
+def describe_tx(tjmtx, tjmtxs, maker_address_set, spending_index):
 
     print('=' * 80)
     print('TRANSACTION UNMIXED:')
@@ -35,23 +65,17 @@ def describe_tx(tjmtx, tjmtxs, maker_address_set):
         print('    %s' % addr)
     print()
     
-    spending_data_per_addr = {}
-    for tx in tjmtxs.values():
-        for vin_idx, vin in enumerate(tx.vin):
-            spending_data_per_addr[vin['txid'], vin['vout']] = ( tx.id, vin_idx )
-    
-    spending_info = OrderedDict()
-    for vout_idx, vout in enumerate(tjmtx.vout):
-        value = vout['value']
+    spending_info = {}
+    for vout_idx, ( vout, value ) in enumerate(zip(tjmtx.vout, tjmtx.vout_values)):
         if value != tjmtx.value_mixed:
             continue
         vout_addrs = get_vout_addresses(vout)
         vout_maker_addrs = set(vout_addrs) & maker_address_set
         if vout_maker_addrs:
             print('MAKER ADDRESSES: %s' % ' '.join(vout_maker_addrs))
-            spending_txid, vin_idx = spending_data_per_addr[tjmtx.id, vout_idx]
+            spending_txid, vin_idx = spending_index[tjmtx.id, vout_idx]
             spending_info.setdefault(spending_txid, []).append(( vout_maker_addrs, value ))
-            print('  %.4f btc is spent from tx %s, vout #%s' %( value, spending_txid, vout_idx))
+            print('  %.4f btc is spent from tx %s, vout #%s' %( satoshis_to_btc(value), spending_txid, vout_idx))
         else:
             print('TAKER: %s' % ' '.join(vout_addrs))
 
@@ -67,20 +91,21 @@ def describe_tx(tjmtx, tjmtxs, maker_address_set):
         print(tx.describe_inout_value_pairs())
         print('Values exploited:')
         for maker_addrs, value in maker_values:
-            print('  %.4f btc is spent from addr %s' % (value, ', '.join(maker_addrs)))
+            print('  %.4f btc is spent from addr %s' % (satoshis_to_btc(value), ', '.join(maker_addrs)))
         print()
         print()
     
-def choose_tx(tjmtxs, unmix_levels, max_parties = 1000):
-    umls = np.array([ uml if uml is not None else 0. for uml in unmix_levels ])
-    parties = np.array([ tx.num_parties for tx in tjmtxs.values() ])
-    grade = umls**2 * parties
-    grade[parties > max_parties] = -1
-    idx = len(grade)-1 - np.argmax(grade[::-1])
-    tx = list(tjmtxs.values())[idx]
-    print('choosing tx: %s (uml=%s, parties=%s)' % (tx.id, umls[idx], parties[idx]))
-    assert tx.unmix_level == umls[idx]
-    assert tx.num_parties == parties[idx]
+def choose_tx(tjmtxs, unmix_levels, num_parties, max_parties = 1000):
+    # unmix_levels is NaN for txs with no unmix level
+    umls = np.nan_to_num(unmix_levels)
+    grade = np.where(num_parties <= max_parties, umls * umls * num_parties, -1)
+    # the last of the txs with the best grade
+    idx = np.flatnonzero(grade == grade.max())[-1]
+    tx = tjmtxs.get_by_index(idx)
+    print('choosing tx: %s (uml=%s, parties=%s)' % (tx.id, tx.unmix_level, num_parties[idx]))
+    # unmix_levels are stored as float32
+    assert np.float32(tx.unmix_level) == umls[idx]
+    assert tx.num_parties == num_parties[idx]
     return tx
 
 def short_tx_repr(tx):
@@ -94,16 +119,23 @@ def main():
     
     args = getopt()
     
-    with gzopen(args.infile, 'rb') as F:
-        tjmtxs, unmix_levels, maker_address_set = pickle.load(F)
-        
     txid = args.tx
+    with zstdopen(args.infile, 'rb') as F:
+        txids = pickle.load(F)
+        maker_address_set = pickle.load(F)
+        spending_index = pickle.load(F)
+        tjmtxs = TxStore(txids, pickle.load(F))
+        # unmix levels and num parties are only needed for choosing the tx
+        if not txid:
+            unmix_levels = pickle.load(F)
+            num_parties = pickle.load(F)
+        
     if txid:
         tjmtx = tjmtxs[txid]
     else:
-        tjmtx = choose_tx(tjmtxs, unmix_levels, max_parties = args.max_parties)
+        tjmtx = choose_tx(tjmtxs, unmix_levels, num_parties, max_parties = args.max_parties)
 
-    describe_tx(tjmtx, tjmtxs, maker_address_set)
+    describe_tx(tjmtx, tjmtxs, maker_address_set, spending_index)
     
 ###############################################################################
 
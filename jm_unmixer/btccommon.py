@@ -4,22 +4,41 @@ Basic tools for working with BTC blockchain/blocks/transactions.
 
 import os
 import json
+import pickle
+import sqlite3
 import decimal
 from datetime import datetime
+from collections import OrderedDict
 
 from http.client import CannotSendRequest, ResponseNotReady, BadStatusLine
-from bitcoinrpc.authproxy import AuthServiceProxy
+from bitcoinrpc.authproxy import AuthServiceProxy, JSONRPCException
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from .misc import memoized_property
 
 ################################################################################
 # Constants
 
 BTCRPC_CONFIG_FILE = os.path.expanduser('~/.bitcoin/bitcoin.conf')
+# the persistent RPC cache is disabled by default (it can grow to many GBs).  enable it by setting
+# RPC_CACHE_FILE, or the JM_UNMIXER_RPC_CACHE_FILE env var, e.g. to ~/.cache/jm_unmixer/rpc_cache.sqlite
+RPC_CACHE_FILE = os.environ.get('JM_UNMIXER_RPC_CACHE_FILE')
+# getblockhash is not cached: the hash at a given height can change in a reorg
+RPC_CACHED_COMMANDS = ( 'getrawtransaction', 'getblock' )
 APPROX_BLOCK_DELTA_SECONDS = 60*10
+SATOSHIS_PER_BTC = 100000000
+TX_CACHE_SIZE = 10000  # a tx json takes ~5KB in memory
+BLOCK_BATCH_SIZE = 100  # number of blocks to fetch per batch RPC call
 
 ################################################################################
 # Communication related
 
 _conn = None
+_config = None
 
 def connection():
     global _conn
@@ -28,9 +47,13 @@ def connection():
     return _conn
 
 def reconnect():
-    global _conn
-    config = read_btcrpc_config()
-    _conn = AuthServiceProxy('http://%s:%s@127.0.0.1:8332' % (config['rpcuser'], config['rpcpassword']))
+    global _conn, _config
+    if _config is None:
+        # only parsed once (also inherited by forked worker processes)
+        _config = read_btcrpc_config()
+    config = _config
+    proxy_cls = OrjsonServiceProxy if orjson is not None else AuthServiceProxy
+    _conn = proxy_cls('http://%s:%s@127.0.0.1:8332' % (config['rpcuser'], config['rpcpassword']))
 
 def disconnect():
     global _conn
@@ -53,11 +76,149 @@ def read_btcrpc_config():
             d[key] = value
     return d
 
+class OrjsonServiceProxy(AuthServiceProxy):
+    """
+    An AuthServiceProxy which parses the responses using orjson, which is much
+    faster than the json module.  Numbers are parsed as floats, not Decimals
+    (tx values are converted to satoshis anyway).
+    """
+
+    def __getattr__(self, name):
+        # make sure the method proxies are OrjsonServiceProxys too
+        proxy = super(OrjsonServiceProxy, self).__getattr__(name)
+        proxy.__class__ = type(self)
+        return proxy
+
+    def _get_response(self):
+        http_response = self._AuthServiceProxy__conn.getresponse()
+        if http_response is None:
+            raise JSONRPCException({
+                'code': -342, 'message': 'missing HTTP response from server'})
+        content_type = http_response.getheader('Content-Type')
+        if content_type != 'application/json':
+            raise JSONRPCException({
+                'code': -342, 'message': 'non-JSON HTTP response with \'%i %s\' from server' % (http_response.status, http_response.reason)})
+        return orjson.loads(http_response.read())
+
+################################################################################
+# Persistent RPC cache
+# Results of RPC_CACHED_COMMANDS are stored in a sqlite db, so they are only
+# fetched from bitcoind once, across runs.
+
+_rpc_cache_db = None
+_rpc_cache_pid = None
+
+def rpc_cache_db():
+    global _rpc_cache_db, _rpc_cache_pid
+    if RPC_CACHE_FILE is None:
+        return None
+    if _rpc_cache_db is None or _rpc_cache_pid != os.getpid():
+        # a sqlite connection can't be shared with forked worker processes
+        os.makedirs(os.path.dirname(os.path.expanduser(RPC_CACHE_FILE)) or '.', exist_ok = True)
+        _rpc_cache_db = sqlite3.connect(os.path.expanduser(RPC_CACHE_FILE), timeout = 60)
+        _rpc_cache_db.execute('PRAGMA journal_mode=WAL')
+        _rpc_cache_db.execute('CREATE TABLE IF NOT EXISTS rpc_cache (key TEXT PRIMARY KEY, value BLOB)')
+        _rpc_cache_pid = os.getpid()
+    return _rpc_cache_db
+
+def _rpc_cache_key(cmd, args):
+    return repr(( cmd, ) + tuple(args))
+
+def rpc_cache_get(keys):
+    """
+    Return the cached results for keys, None for missing keys.
+    """
+    db = rpc_cache_db()
+    if db is None:
+        return [ None ] * len(keys)
+    results = []
+    for key in keys:
+        row = db.execute('SELECT value FROM rpc_cache WHERE key = ?', ( key, )).fetchone()
+        results.append(pickle.loads(row[0]) if row is not None else None)
+    return results
+
+def rpc_cache_put(cmd, key_result_pairs):
+    db = rpc_cache_db()
+    if db is None:
+        return
+    rows = [
+        ( key, pickle.dumps(result, pickle.HIGHEST_PROTOCOL) )
+        for key, result in key_result_pairs
+        if _is_final_result(cmd, result)
+    ]
+    with db:
+        db.executemany('INSERT OR REPLACE INTO rpc_cache VALUES (?, ?)', rows)
+
+def _is_final_result(cmd, result):
+    # Results which can still change are not cached: unconfirmed txs.
+    # A block's (stripped, see below) content never changes, even if it is reorged away.
+    # Note the "confirmations" field of cached txs is not kept up to date.
+    if cmd == 'getrawtransaction':
+        return 'blockhash' in result
+    return True
+
+# Fields dropped from the results of RPC_CACHED_COMMANDS: fields which can change in a
+# reorg (a block's next block), and fields which are not used and are large (the raw tx hex).
+# They are dropped whether or not the result comes from the cache, so callers always get
+# the same fields.
+RPC_DROPPED_FIELDS = {
+    'getrawtransaction': ( 'hex', ),
+    'getblock': ( 'nextblockhash', 'confirmations' ),
+}
+
+def _strip_result(cmd, result):
+    fields = [ field for field in RPC_DROPPED_FIELDS.get(cmd, ()) if field in result ]
+    if fields:
+        result = dict(result)
+        for field in fields:
+            del result[field]
+    return result
+
+def rpc_cached(func):
+    def f(cmd, *args):
+        if cmd not in RPC_CACHED_COMMANDS:
+            return func(cmd, *args)
+        key = _rpc_cache_key(cmd, args)
+        result, = rpc_cache_get([ key ])
+        if result is None:
+            result = _strip_result(cmd, func(cmd, *args))
+            rpc_cache_put(cmd, [ ( key, result ) ])
+        return result
+    return f
+
+################################################################################
+# Running commands
+
+@rpc_cached
 @autoreconnect
 def run_command(cmd, *args):
     func = getattr(connection(), cmd)
     return func(*args)
 
+def run_batch(cmd, args_list):
+    """
+    Run the same command for each of the args in args_list, in a single RPC round-trip.
+    Cached results are not re-fetched.
+    """
+    args_list = [ tuple(args) for args in args_list ]
+    if cmd not in RPC_CACHED_COMMANDS:
+        return _run_batch(cmd, args_list)
+    keys = [ _rpc_cache_key(cmd, args) for args in args_list ]
+    results = rpc_cache_get(keys)
+    missing_idxs = [ i for i, result in enumerate(results) if result is None ]
+    fetched_results = _run_batch(cmd, [ args_list[i] for i in missing_idxs ])
+    for i, result in zip(missing_idxs, fetched_results):
+        results[i] = _strip_result(cmd, result)
+    rpc_cache_put(cmd, [ ( keys[i], results[i] ) for i in missing_idxs ])
+    return results
+
+@autoreconnect
+def _run_batch(cmd, args_list):
+    calls = [ [ cmd ] + list(args) for args in args_list ]
+    if not calls:
+        return []
+    return connection().batch_(calls)
+
 ################################################################################
 # BlockChain
 
@@ -77,12 +238,20 @@ class BlockChain(object):
     def get_block_by_id(self, bid):
         return run_command('getblock', bid)
 
+    def get_blocks_by_heights(self, heights):
+        bids = run_batch('getblockhash', [ ( h, ) for h in heights ])
+        return self.get_blocks_by_ids(bids)
+
+    def get_blocks_by_ids(self, bids):
+        return run_batch('getblock', [ ( bid, ) for bid in bids ])
+
     def get_num_blocks(self):
         return run_command('getblockcount')
 
-    def iter_blocks_by_heights(self, heights):
-        for h in heights:
-            yield self.get_block_by_height(h)
+    def iter_blocks_by_heights(self, heights, batch_size = BLOCK_BATCH_SIZE):
+        heights = list(heights)
+        for i in range(0, len(heights), batch_size):
+            yield from self.get_blocks_by_heights(heights[i:i+batch_size])
 
     def iter_blocks_by_ids(self, from_bid, to_bid):
         # to_bid can be None, meaning until the end
@@ -92,7 +261,15 @@ class BlockChain(object):
             yield block
             if to_bid is not None and to_bid == bid:
                 break
-            bid = block['nextblockhash']
+            bid = self.get_next_block_id(bid)
+            if bid is None:
+                # reached the tip
+                break
+
+    def get_next_block_id(self, bid):
+        # not taken from the (cached) getblock result: the next block can change in a reorg.
+        # getblockheader is not cached.
+        return run_command('getblockheader', bid).get('nextblockhash')
             
 ################################################################################
 
@@ -148,16 +325,42 @@ class Block(object):
 
 class Tx(object):
     
-    def __init__(self, json):
+    def __init__(self, json, parent_vouts = None):
         self.json = json
+        # values are kept as int satoshis, to avoid Decimal arithmetic
+        self.vout_values = [ btc_to_satoshis(vout['value']) for vout in json['vout'] ]
+        # (txid, vout_idx) -> vout json, of the vouts being spent by this tx (see get_parent_vouts)
+        self.parent_vouts = parent_vouts if parent_vouts is not None else {}
     
     @classmethod
     def from_id(cls, txid):
-        return cls(run_command(
-            'getrawtransaction',
-            txid,
-            1,  # verbose=True, i.e. json formatted
-        ))
+        json = _get_cached_tx_json(txid)
+        if json is None:
+            # not added to the cache: txs fetched one by one (e.g. the txs scanned by
+            # find_jmtxs.py) are typically not used again
+            json = run_command(
+                'getrawtransaction',
+                txid,
+                1,  # verbose=True, i.e. json formatted
+            )
+        return cls(json)
+    
+    @classmethod
+    def from_ids(cls, txids):
+        """
+        Same as from_id, for multiple txs.  Txs which are not cached are fetched
+        in a single batch RPC call.
+        """
+        txids = list(txids)
+        jsons = { txid: _get_cached_tx_json(txid) for txid in txids }
+        missing_txids = [ txid for txid, json in jsons.items() if json is None ]
+        fetched_jsons = run_batch('getrawtransaction', [ ( txid, 1 ) for txid in missing_txids ])
+        for txid, json in zip(missing_txids, fetched_jsons):
+            jsons[txid] = json
+            _set_cached_tx_json(txid, json)
+        # a single Tx per distinct txid (repeated txids share it)
+        txs = { txid: cls(json) for txid, json in jsons.items() }
+        return [ txs[txid] for txid in txids ]
     
     #===================================================================================================================
     # properties
@@ -193,14 +396,11 @@ class Tx(object):
     # inputs / outputs
     #===================================================================================================================
 
-    @property
-    def vout_values(self):
-        return [ vout['value'] for vout in self.vout ]
-
-    @property
+    @memoized_property
     def vin_values(self):
+        parent_vouts = self.get_parent_vouts()
         return [
-            self.get_vout_being_spent_by_vin(vin)['value']
+            btc_to_satoshis(parent_vouts[vin['txid'], vin['vout']]['value'])
             for vin in self.vin
         ]
 
@@ -212,10 +412,30 @@ class Tx(object):
     def total_vin_value(self):
         return sum(self.vin_values)
     
+    def get_txs_being_spent(self):
+        # fetch all the txs being spent by the vins in a single batch RPC call, instead
+        # of one RPC per vin.  returns the tx being spent by each vin.
+        return Tx.from_ids(vin['txid'] for vin in self.vin)
+
+    def get_parent_vouts(self):
+        """
+        Returns a (txid, vout_idx) -> vout dict of the vouts being spent by this tx.
+        The dict is kept on the tx (and pickled with it), so once it is populated,
+        no RPCs are needed for accessing the vouts being spent.
+        """
+        if len(self.parent_vouts) < len(self.vin):
+            self.parent_vouts = {
+                ( vin['txid'], vin['vout'] ): parent_tx.vout[vin['vout']]
+                for vin, parent_tx in zip(self.vin, self.get_txs_being_spent())
+            }
+        return self.parent_vouts
+
     def get_vout_being_spent_by_vin(self, vin):
-        tx = Tx.from_id(vin['txid'])
-        vout = tx.vout[vin['vout']]
-        return vout
+        try:
+            return self.parent_vouts[vin['txid'], vin['vout']]
+        except KeyError:
+            tx = Tx.from_id(vin['txid'])
+            return tx.vout[vin['vout']]
     
     @property
     def fee(self):
@@ -231,8 +451,44 @@ class Tx(object):
     def __str__(self):
         doc = dict(self.json)
         doc.pop('hex', None)
+        if orjson is not None:
+            # note the formatting differs from the json module's: e.g. orjson prints 0.00001
+            # where json prints 1e-05, and writes non-ASCII chars as is instead of \uXXXX escapes
+            return orjson.dumps(doc, option = orjson.OPT_INDENT_2, default = _decimal_to_float).decode()
         return json.dumps(doc, indent = 2, cls = DecimalEncoder)
 
+################################################################################
+# Tx cache
+# Txs are immutable, so there is no need to ever invalidate cached tx jsons.
+# The cache is only bounded in size (LRU).
+# Only the txs fetched by Tx.from_ids (i.e. the txs being spent by the txs being
+# processed) are added to the cache, because those are the ones likely to be reused.
+
+_tx_json_cache = OrderedDict()
+
+def _get_cached_tx_json(txid):
+    try:
+        json = _tx_json_cache[txid]
+    except KeyError:
+        return None
+    _tx_json_cache.move_to_end(txid)
+    return json
+
+def _set_cached_tx_json(txid, json):
+    _tx_json_cache[txid] = json
+    if len(_tx_json_cache) > TX_CACHE_SIZE:
+        _tx_json_cache.popitem(last = False)
+
+################################################################################
+# values
+
+def btc_to_satoshis(value):
+    return int(round(value * SATOSHIS_PER_BTC))
+
+def satoshis_to_btc(value):
+    # a Decimal with 8 decimal digits, the way bitcoind formats values
+    return decimal.Decimal(value).scaleb(-8)
+
 ################################################################################
 # misc
 
@@ -242,6 +498,12 @@ class DecimalEncoder(json.JSONEncoder):
             return float(o)
         return super(DecimalEncoder, self).default(o)
 
+def _decimal_to_float(o):
+    # the orjson equivalent of DecimalEncoder
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    raise TypeError
+
 ################################################################################
 # misc conveniences
 
@@ -2,13 +2,12 @@
 Representation and basic analysis (input/output pairing) of JM transactions.
 """
 
-from decimal import Decimal
-from collections import Counter
-from itertools import zip_longest, combinations
+from itertools import zip_longest
+from functools import lru_cache
 import numpy as np
 
-from .misc import memoized_property
-from .btccommon import Tx
+from .misc import memoized_property, njit
+from .btccommon import Tx, satoshis_to_btc
 
 ################################################################################
 # Constants
@@ -16,9 +15,10 @@ from .btccommon import Tx
 MIN_NUM_INPUTS = 3
 MIN_NUM_OUTPUTS = 3
 
-MIN_JM_FEE = 0.000001
-MAX_JM_FEE = 0.03
-MIN_MIX_VALUE = Decimal('0.01')
+# values are in satoshis
+MIN_JM_FEE = 100  # 0.000001 btc
+MAX_JM_FEE = 3000000  # 0.03 btc
+MIN_MIX_VALUE = 1000000  # 0.01 btc
 #MIN_JM_RAW_TX_SIZE = 1500  # raw-size of a jmtx can't be smaller than this
 
 class Unpairable(Exception):
@@ -50,44 +50,57 @@ class JoinMarketTx(Tx):
     
     @memoized_property
     def value_mixed(self):
-        values = set(self.pairs[0][1])
-        for pair in self.pairs[1:]:
-            values = values & set(pair[1])
+        # the only output value common to all pairs
+        values = set(self.pairs[0][1]).intersection(*( pair[1] for pair in self.pairs[1:] ))
         x, = values
         return x
 
-    @property
+    @memoized_property
     def mixed_vouts(self):
-        return [ vout for vout in self.vout if vout['value'] == self.value_mixed ]
+        value_mixed = self.value_mixed
+        return [ vout for vout, value in zip(self.vout, self.vout_values) if value == value_mixed ]
 
-    @property
+    @memoized_property
     def num_parties(self):
         return len(self.pairs)
 
-    @property
+    @memoized_property
+    def _pair_fees(self):
+        # the fee paid to each pair (negative for the taker)
+        return [ fee_paid_to_pair(p) for p in self.pairs ]
+
+    @memoized_property
+    def _taker_idx(self):
+        # the first pair paying a fee (stop scanning there)
+        idx = next(( i for i, fee in enumerate(self._pair_fees) if fee < 0 ), None)
+        if idx is None:
+            # not letting StopIteration escape a property
+            raise ValueError('no taker pair in %s' % self.id)
+        return idx
+
+    @memoized_property
     def taker_value_pair(self):
-        return [ p for p in self.pairs if float(fee_paid_by_pair(p)) > 0 ][0]
+        return self.pairs[self._taker_idx]
 
-    @property
+    @memoized_property
     def maker_value_pairs(self):
-        return [ p for p in self.pairs if float(fee_paid_to_pair(p)) >= 0 ]
+        return [ p for p, fee in zip(self.pairs, self._pair_fees) if fee >= 0 ]
 
-    @property
+    @memoized_property
     def taker_input_values(self):
         return self.taker_value_pair[0]
     
-    @property
+    @memoized_property
     def taker_output_values(self):
         return self.taker_value_pair[1]
     
-    @property
+    @memoized_property
     def txfee(self):
         return sum(sum(p[0]) for p in self.pairs) - sum(sum(p[1]) for p in self.pairs)
     
-    @property
+    @memoized_property
     def total_jm_fee(self):
-        taker_pair = self.taker_value_pair
-        total_taker_fee = sum(taker_pair[0]) - sum(taker_pair[1])
+        total_taker_fee = -self._pair_fees[self._taker_idx]
         return total_taker_fee - self.txfee
 
     def describe_inout_value_pairs(self):
@@ -97,14 +110,14 @@ class JoinMarketTx(Tx):
         # taker
         lines.append('[TAKER]')
         lines.extend(self._describe_pair(self.taker_value_pair, 0, value_mixed))
-        lines.append('  %s  %s' % (fmt('(JMFEE=%s)' % self.total_jm_fee), fmt(None)))
-        lines.append('  %s  %s' % (fmt('(TXFEE=%s)' % self.txfee), fmt(None)))
+        lines.append('  %s  %s' % (fmt('(JMFEE=%s)' % satoshis_to_btc(self.total_jm_fee)), fmt(None)))
+        lines.append('  %s  %s' % (fmt('(TXFEE=%s)' % satoshis_to_btc(self.txfee)), fmt(None)))
         # makers
         for pidx, pair in enumerate(self.maker_value_pairs):
             lines.append('[MAKER %s]' % pidx)
             lines.extend(self._describe_pair(pair, pidx + 1, value_mixed))
             maker_fee = fee_paid_to_pair(pair)
-            lines.append('  %s  %s' % (fmt(None), fmt('(JMFEE=%s)' % maker_fee)))
+            lines.append('  %s  %s' % (fmt(None), fmt('(JMFEE=%s)' % satoshis_to_btc(maker_fee))))
             #lines.append('')
         return '\n'.join(lines)
     
@@ -119,28 +132,35 @@ class JoinMarketTx(Tx):
     def _format_value(self, v, pref, add_mark = False):
         suffix = ' **' if add_mark else ''
         pref = '%s: ' % pref if pref is not None else ''
+        if isinstance(v, int):
+            v = satoshis_to_btc(v)
         return ' '*23 if v is None else '%s%18s%s' % ( pref, v, suffix)
     
     def __repr__(self):
         x = super().__repr__()
         extra = '{%dx %.3f btc, %s->%s inouts}' % (
-            len(self.pairs), self.value_mixed, len(self.vin), len(self.vout))
+            len(self.pairs), satoshis_to_btc(self.value_mixed), len(self.vin), len(self.vout))
         return '%s %s%s' % ( x[:-1], extra , x[-1:] )
 
 class UnmixedJoinMarketTx(JoinMarketTx):
     
     def __init__(self, jmtx, maker_addresses = ()):
-        super(UnmixedJoinMarketTx, self).__init__(jmtx.json, jmtx.pairs)
+        super(UnmixedJoinMarketTx, self).__init__(jmtx.json, jmtx.pairs, parent_vouts = jmtx.parent_vouts)
         self.maker_addresses = set(maker_addresses)
 
     def add_maker_address(self, addr):
         self.maker_addresses.add(addr)
+        # invalidate the memoized properties which depend on maker_addresses
+        getattr(self, '_cache', {}).pop('possible_taker_mixed_vouts', None)
 
-    @property
+    @memoized_property
     def possible_taker_mixed_vouts(self):
+        maker_addresses = self.maker_addresses
+        if not maker_addresses:
+            return list(self.mixed_vouts)
         return [
             vout for vout in self.mixed_vouts
-            if not (self.maker_addresses & set(get_vout_addresses(vout)))
+            if not any(addr in maker_addresses for addr in get_vout_addresses(vout))
         ]
 
     @property
@@ -172,6 +192,10 @@ def check_potential_joinmarket_tx(tx):
         return False, 'MIN_NUM_OUTPUTS'
     if num_inputs <= MIN_NUM_INPUTS:
         return False, 'MIN_NUM_INPUTS'
+    # avoid processing insane transactions
+    if num_inputs > 25:
+        return False, 'TOO MANY INPUTS'
+    
     value_mixed, count = get_value_mixed(tx)
     if value_mixed is None:
         return False, 'no value_mixed'
@@ -182,10 +206,6 @@ def check_potential_joinmarket_tx(tx):
     if not (2*count-1 <= num_outputs <= 2*count):
         return False, 'UNUSUAL NUMBER OF OUTPUTS'
 
-    # avoid processing insane transactions
-    if num_inputs > 25:
-        return False, 'TOO MANY INPUTS'
-
     return True, ''
 
 def to_joinmarket_tx(tx, *args, **kwargs):
@@ -201,22 +221,23 @@ def to_joinmarket_tx(tx, *args, **kwargs):
     vout_values = tx.vout_values
     pairs = pair_up_inout_values(vin_values, vout_values)  # can raise Unpairable
 
-    return JoinMarketTx(tx, pairs, *args, **kwargs)
+    # the vouts being spent are kept on the jmtx, so analyzing it later doesn't require RPCs
+    return JoinMarketTx(tx, pairs, *args, parent_vouts = tx.get_parent_vouts(), **kwargs)
 
 def get_value_mixed(tx):
-    return get_value_mixed_from_values(tx.vin_values, tx.vout_values)
+    # the input values are not needed, and getting them would fetch the txs being spent
+    return get_value_mixed_from_values((), tx.vout_values)
 
 def get_value_mixed_from_values(in_values, out_values):
-    output_values_counter = Counter(out_values)
-    common_output_value, common_output_value_count = output_values_counter.most_common(1)[0]
-    output_values_counter.pop(common_output_value)
+    values, counts = np.unique(np.asarray(out_values), return_counts = True)
+    i = counts.argmax()
+    common_output_value, common_output_value_count = values[i].item(), counts[i].item()
     if common_output_value_count <= 2:
         # 2 meaning 2-party coinjoin, which is unlikely because it has little value
         return None, None
-    if output_values_counter:
-        v2, v2_count = output_values_counter.most_common(1)[0]
-        if v2_count == common_output_value_count:
-            return None, None
+    if len(counts) > 1 and np.partition(counts, -2)[-2] == common_output_value_count:
+        # no single most common value
+        return None, None
     return common_output_value, common_output_value_count
 
 def fee_paid_to_pair(pair):
@@ -228,11 +249,51 @@ def fee_paid_by_pair(pair):
 def get_vout_addresses(vout):
     return vout['scriptPubKey']['addresses']
 
+def get_maker_vout_idxs(vouts, maker_address_set):
+    """
+    Return the indices of the vouts which have any of the addresses in maker_address_set.
+    """
+    # the hot loop of the unmixing pass, so the address lookup is inlined
+    idxs = []
+    for i, vout in enumerate(vouts):
+        for addr in vout['scriptPubKey']['addresses']:
+            if addr in maker_address_set:
+                idxs.append(i)
+                break
+    return idxs
+
+def get_spending_index(txs):
+    """
+    Map (txid, vout_idx) of each output spent by txs to the spending (txid, vin_idx).
+    """
+    spending_index = {}
+    for tx in txs:
+        txid = tx.id
+        for vin_idx, vin in enumerate(tx.vin):
+            spending_index[vin['txid'], vin['vout']] = ( txid, vin_idx )
+    return spending_index
+
+def compute_unmix_levels(num_parties, num_possible_takers):
+    """
+    A vectorized version of UnmixedJoinMarketTx.unmix_level, over arrays of
+    jmtxs.  unmix level is NaN for jmtxs with no possible takers.
+    Returns a float32 array (plenty of precision for a ratio, at half the size).
+    """
+    num_parties = np.asarray(num_parties, dtype = np.float64)
+    num_possible_takers = np.asarray(num_possible_takers, dtype = np.float64)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        unmix_levels = (num_parties - num_possible_takers) / (num_parties - 1)
+    unmix_levels[num_possible_takers == 0] = np.nan
+    return unmix_levels.astype(np.float32)
+
 
 ################################################################################
 # The JM inputs/outputs pairing algorithm
 ################################################################################
 
+# the max jmfees (distances between the inputs and the outputs of a pair) tried when pairing
+_DISTS = tuple( MIN_JM_FEE * 2**i for i in range(4, 40) if MIN_JM_FEE * 2**i < MAX_JM_FEE )
+
 def pair_up_inout_values(in_values, out_values, value_mixed = None):
     if value_mixed is None:
         value_mixed = get_value_mixed_from_values(in_values, out_values)[0]
@@ -243,18 +304,18 @@ def _pair_up_inout_values(in_values, out_values, value_mixed = None):
 
     # split outputs to mix_values and change_values
     in_values = list(in_values)
-    change_values = list(out_values)
     mix_values = []
-    while True:
-        try:
-            change_values.remove(value_mixed)
-            mix_values.append(value_mixed)
-        except ValueError:
-            break
+    change_values = []
+    for value in out_values:
+        (mix_values if value == value_mixed else change_values).append(value)
     change_values.sort()
     num_parties = len(mix_values)
     
-    txfee = sum(in_values) - sum(out_values)
+    # running totals of the values not paired yet
+    sum_in_values = sum(in_values)
+    sum_change_values = sum(change_values)
+    
+    txfee = sum_in_values - sum_change_values - num_parties * value_mixed
     assert txfee >= 0, txfee
     
     # we look for input groups of size i to match any of the outputs.
@@ -264,49 +325,44 @@ def _pair_up_inout_values(in_values, out_values, value_mixed = None):
     num_pairs_left = num_parties
     cur_max_jmfee = 16*MIN_JM_FEE
     bucket_sizes = range(1, len(in_values) - num_pairs_left + 2)
-    dists = MIN_JM_FEE * 2**np.arange(4, 40)
-    dists = dists[dists < MAX_JM_FEE]
+    # paired values are marked as not live, instead of being removed
+    in_values = np.array(in_values, dtype = np.int64)
+    change_values = np.array(change_values, dtype = np.int64)
+    in_live = np.ones(len(in_values), dtype = np.bool_)
+    change_live = np.ones(len(change_values), dtype = np.bool_)
     while num_pairs_left > 1:
-        found_new_pair = False
-        for bucket_size, cur_max_jmfee in gen_bucket_size_dist_pairs(bucket_sizes, dists):
+        num_live_inputs, suffix_min_sums, suffix_max_sums = _get_suffix_sum_bounds(in_values, in_live)
+        for bucket_size, cur_max_jmfee in gen_bucket_size_dist_pairs(bucket_sizes, _DISTS):
             #print('XXX %s %s' % (bucket_size, cur_max_jmfee))
-            for iidxs in combinations(range(len(in_values)), bucket_size):
-                sum_bucket_input = sum( in_values[iidx] for iidx in iidxs )
-                min_dist = cur_max_jmfee
-                min_dist_cidx = -1
-                for cidx, change_value in enumerate(change_values):
-                    dist = change_value + value_mixed - sum_bucket_input
-                    if MIN_JM_FEE < dist < min_dist:
-                        min_dist = dist
-                        min_dist_cidx = cidx
-                if min_dist_cidx >= 0:
-                    # found a pair
-                    cur_inputs = []
-                    for iidx in reversed(iidxs):
-                        cur_inputs.append(in_values[iidx])
-                        in_values = in_values[:iidx] + in_values[iidx+1:]
-                    cur_outputs = [ mix_values.pop(), change_values[min_dist_cidx] ]
-                    change_values = change_values[:min_dist_cidx] + change_values[min_dist_cidx+1:]
-                    pairs.append([ cur_inputs, cur_outputs ])
-                    num_pairs_left -= 1
-                    #print('pair found: max_jmfee=%.7f bucket=%s pairs_left=%s inputs_left=%s' % (cur_max_jmfee, bucket_size, num_pairs_left, len(in_values)))
-                    # starting over this bucket size
-                    found_new_pair = True
-                    break
-            if found_new_pair:
+            iidxs, min_dist_cidx = _find_pair(
+                in_values, in_live, change_values, change_live, value_mixed, bucket_size,
+                cur_max_jmfee, MIN_JM_FEE, num_live_inputs, suffix_min_sums, suffix_max_sums)
+            if min_dist_cidx >= 0:
+                # found a pair
+                cur_inputs = in_values[iidxs[::-1]].tolist()
+                in_live[iidxs] = False
+                cur_outputs = [ mix_values.pop(), int(change_values[min_dist_cidx]) ]
+                change_live[min_dist_cidx] = False
+                sum_in_values -= sum(cur_inputs)
+                sum_change_values -= cur_outputs[1]
+                pairs.append([ cur_inputs, cur_outputs ])
+                num_pairs_left -= 1
+                #print('pair found: max_jmfee=%.7f bucket=%s pairs_left=%s inputs_left=%s' % (cur_max_jmfee, bucket_size, num_pairs_left, in_live.sum()))
                 # found -- start over, with smaller inputs
                 break
         else:
             # done, not found anything -- abort
             break
+    in_values = in_values[in_live].tolist()
+    change_values = change_values[change_live].tolist()
     
     if num_pairs_left == 1:
         # only taker is left
         assert len(mix_values) == num_pairs_left, (len(mix_values), num_pairs_left)
-        sum_inputs = sum(in_values)
-        sum_outputs = sum(change_values) + sum(mix_values)
-        total_jmfee = sum_inputs - sum_outputs - txfee
-        if not MIN_JM_FEE < total_jmfee / (num_parties-1) < MAX_JM_FEE:
+        sum_outputs = sum_change_values + num_pairs_left * value_mixed
+        total_jmfee = sum_in_values - sum_outputs - txfee
+        # the average maker fee, total_jmfee / (num_parties-1), must be within the fee bounds
+        if not MIN_JM_FEE * (num_parties-1) < total_jmfee < MAX_JM_FEE * (num_parties-1):
             raise Unpairable('taker fees dont add up')
         pair = [ in_values, mix_values + change_values ]
         pairs = [ pair ] + pairs
@@ -319,13 +375,114 @@ def _pair_up_inout_values(in_values, out_values, value_mixed = None):
 
     return pairs
 
+@njit('boolean(int64, int64, int64, int64, int64, int64[:, :], int64[:, :])', cache = True)
+def _may_match(partial_sum, num_left, start, min_sum, max_sum, suffix_min_sums, suffix_max_sums):
+    """
+    Can a partial combination be completed, by num_left of the live inputs from start
+    onwards, to a combination whose sum is in the range (min_sum, max_sum)?
+    """
+    return (
+        partial_sum + suffix_min_sums[start, num_left] < max_sum and
+        partial_sum + suffix_max_sums[start, num_left] > min_sum
+    )
+
+@njit('Tuple((int64[:], int64[:, :], int64[:, :]))(int64[:], boolean[:])', cache = True)
+def _get_suffix_sum_bounds(values, live):
+    """
+    Returns ( num_live, min_sums, max_sums ), where num_live[j] is the number of live
+    values in values[j:], and min_sums[j, r] (max_sums[j, r]) is the sum of the r smallest
+    (largest) live values of values[j:].
+    Used for bounding the sums of the input combinations, without changing the order in
+    which they are enumerated.
+    """
+    n = len(values)
+    num_live = np.zeros(n + 1, dtype = np.int64)
+    min_sums = np.zeros((n + 1, n + 1), dtype = np.int64)
+    max_sums = np.zeros((n + 1, n + 1), dtype = np.int64)
+    for j in range(n):
+        suffix = np.sort(values[j:][live[j:]])
+        m = len(suffix)
+        num_live[j] = m
+        min_sums[j, 1:m+1] = np.cumsum(suffix)
+        max_sums[j, 1:m+1] = np.cumsum(suffix[::-1])
+    return num_live, min_sums, max_sums
+
+@njit(
+    'Tuple((int64[:], int64))('
+    'int64[:], boolean[:], int64[:], boolean[:], int64, int64, int64, int64, int64[:], int64[:, :], int64[:, :])',
+    cache = True)
+def _find_pair(in_values, in_live, change_values, change_live, value_mixed, bucket_size,
+               max_jmfee, min_jmfee, num_live_inputs, suffix_min_sums, suffix_max_sums):
+    """
+    Finds the first (in lexicographic order) combination of bucket_size live inputs which
+    is matched by a live change value, i.e. change_value + value_mixed - sum(inputs) is in
+    the range (min_jmfee, max_jmfee).  Of the matching change values, the one with the
+    smallest distance is chosen.
+    num_live_inputs, suffix_min_sums and suffix_max_sums are the values returned by
+    _get_suffix_sum_bounds.
+    Returns ( iidxs, cidx ).  cidx is -1 if not found.
+    """
+    n = len(in_values)
+    iidxs = np.empty(bucket_size, dtype = np.int64)
+    if not change_live.any():
+        return iidxs, -1
+    # a combination can only be matched if its sum is in the range (min_sum, max_sum)
+    live_change_values = change_values[change_live]
+    min_sum = live_change_values.min() + value_mixed - max_jmfee
+    max_sum = live_change_values.max() + value_mixed - min_jmfee
+    # iidxs[:depth] is the current (partial) combination, and i is the next
+    # input index to push
+    depth = 0
+    i = 0
+    cur_sum = 0
+    while True:
+        if depth == bucket_size:
+            min_dist = max_jmfee
+            min_dist_cidx = -1
+            for cidx in range(len(change_values)):
+                if not change_live[cidx]:
+                    continue
+                dist = change_values[cidx] + value_mixed - cur_sum
+                if min_jmfee < dist < min_dist:
+                    min_dist = dist
+                    min_dist_cidx = cidx
+            if min_dist_cidx >= 0:
+                return iidxs, min_dist_cidx
+        if depth == bucket_size or num_live_inputs[i] < bucket_size - depth:
+            # pop
+            if depth == 0:
+                return iidxs, -1
+            depth -= 1
+            cur_sum -= in_values[iidxs[depth]]
+            i = iidxs[depth] + 1
+        elif not in_live[i] or not _may_match(
+                cur_sum + in_values[i], bucket_size - depth - 1, i + 1,
+                min_sum, max_sum, suffix_min_sums, suffix_max_sums):
+            # skip i.  if live, prune the subtree of combinations starting with iidxs[:depth] + [i]
+            i += 1
+        else:
+            # push
+            iidxs[depth] = i
+            cur_sum += in_values[i]
+            depth += 1
+            i += 1
+
 def gen_bucket_size_dist_pairs(bucket_sizes, dists):
+    for bucket_idx, dist_idx in _pair_order(len(bucket_sizes), len(dists)).tolist():
+        yield bucket_sizes[bucket_idx], dists[dist_idx]
+
+@lru_cache(maxsize = 64)
+def _pair_order(num_bucket_sizes, num_dists):
+    """
+    Returns the ( bucket_idx, dist_idx ) pairs, in the order gen_bucket_size_dist_pairs
+    generates them.  The order only depends on the sizes, so it is only computed once
+    per sizes.
+    """
     DIST_PENALTY_FACTOR = 0.1
-    num_bucket_sizes = len(bucket_sizes)
-    num_dists = len(dists)
     ii = np.indices((num_bucket_sizes, num_dists))
     d = ii[0]**2 + DIST_PENALTY_FACTOR * ii[1]**2
-    for bucket_idx, dist_idx in zip(*divmod(np.argsort(d, axis=None), d.shape[1])):
-        yield bucket_sizes[bucket_idx], dists[dist_idx]
+    order = np.column_stack(divmod(np.argsort(d, axis=None), num_dists)).astype(np.int32)
+    order.flags.writeable = False  # shared by all callers
+    return order
 
 ################################################################################
@@ -31,19 +31,28 @@ class memoized_property(object):
 ################################################################################
 # pickle related
 
+import io
 import pickle
 
+# protocol 5 (python3.8+) pickles numpy arrays with less copying
+PICKLE_PROTOCOL = 5
+
 def pkl_append(fn, obj):
     with gzopen(fn, 'ab') as f:
-        pickle.dump(obj, f)
+        pickle.dump(obj, f, protocol = PICKLE_PROTOCOL)
+
+PKL_READ_BUFFER_SIZE = 1 << 20
 
 def iter_pkl_list(fn):
     with gzopen(fn, 'rb') as f:
-        while True:
-            try:
+        if isinstance(f, GzipFile):
+            # decompress in large chunks
+            f = io.BufferedReader(f, buffer_size = PKL_READ_BUFFER_SIZE)
+        try:
+            while True:
                 yield pickle.load(f)
-            except (EOFError, IOError):
-                break
+        except (EOFError, IOError):
+            pass
 
 ################################################################################
 # reading/writing gzipped files
@@ -64,24 +73,14 @@ def gzopen(path, mode = 'r', add_ext = None, **kwargs):
     if add_ext is None:
         add_ext = look_for_existing
 
-    orig_path = path
-    orig_path_exists = os.path.isfile(orig_path)
-    if add_ext:
-        gz_path = _to_gzip_extension(orig_path)
-    else:
-        gz_path = orig_path
-    gz_path_exists = os.path.isfile(gz_path)
-    
+    target_path = path
     if add_ext:
-        target_path = gz_path
-    else:
-        target_path = orig_path
-
-    if look_for_existing:
-        if not orig_path_exists and gz_path_exists:
+        gz_path = _to_gzip_extension(path)
+        if not look_for_existing:
+            target_path = gz_path
+        elif gz_path != path and not os.path.isfile(path) and os.path.isfile(gz_path):
+            # the file only exists with the gz extension
             target_path = gz_path
-        else:
-            target_path = orig_path
         
     if _is_gzip(target_path):
         open_func = GzipFile
@@ -112,35 +111,82 @@ def _modify_gzip_extension(path, extensions, strict = True):
     else:
         return path
 
+###############################################################################
+# reading/writing zstd-compressed files
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZSTD_EXTENSION = '.zst'
+
+def zstdopen(path, mode = 'rb', **kwargs):
+    """
+    Open a zstd-compressed file (.zst), in binary mode.  Compression is
+    multi-threaded.
+    Other files are opened using gzopen.
+    """
+    if not str(path).endswith(ZSTD_EXTENSION):
+        return gzopen(path, mode, **kwargs)
+    if zstandard is None:
+        raise ImportError('zstandard is required for reading/writing %s files' % ZSTD_EXTENSION)
+    if mode[0] in 'wa':
+        cctx = zstandard.ZstdCompressor(level = 3, threads = -1)
+        return zstandard.open(path, mode, cctx = cctx)
+    return zstandard.open(path, mode)
+
 ###############################################################################
 # progress bar
 
 try:
     from click import progressbar
 except ImportError:
-    class progressbar(object):
-        def __init__(self, x):
-            self.x = x
-        def __enter__(self):
-            return self.x
-        def __exit__(self, *args):
-            return False
+    from contextlib import contextmanager
+    @contextmanager
+    def progressbar(iterable, length = None, **kwargs):
+        # no progress bar, only click.progressbar's interface
+        yield iterable
 
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Pool
+from operator import length_hint
 
-def map_with_progressbar(func, arglist, num_workers, preserve_order = True):
+def map_with_progressbar(func, arglist, num_workers, preserve_order = True, total = None,
+                         initializer = None, initargs = (), chunksize = None):
     """
     Run tasks in a process-pool and generate the results, while displaying
     a progress bar.
+    Tasks are sent to the workers in chunks of chunksize tasks, to reduce the
+    IPC overhead of many short tasks.  By default, each worker gets ~4 chunks.
+    total is the number of tasks, if arglist has no len().
+    initializer(*initargs) is called once in each worker process.  It must not
+    raise: multiprocessing.Pool keeps respawning workers whose initializer fails.
     """
-    with ProcessPoolExecutor(max_workers = num_workers) as executor:
-        futs = [ executor.submit(func, args) for args in arglist ]
+    if total is None:
+        total = length_hint(arglist)
+    if chunksize is None:
+        chunksize = max(1, total // (num_workers * 4))
+    with Pool(num_workers, initializer, initargs) as pool:
         if preserve_order:
-            prgbar = progressbar(futs)
+            results = pool.imap(func, arglist, chunksize = chunksize)
         else:
-            prgbar = progressbar(as_completed(futs), length = len(futs))
-        with prgbar as futures:
-            for fut in futures:
-                yield fut.result()
+            results = pool.imap_unordered(func, arglist, chunksize = chunksize)
+        with progressbar(results, length = total) as RESULTS:
+            yield from RESULTS
+
+###############################################################################
+# numba
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """
+        A no-op replacement of numba.njit, used when numba is not installed.
+        The decorated functions then run as regular (slow) python functions.
+        """
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
 
 ###############################################################################